@@ -0,0 +1,277 @@
+import multiprocessing
+import os
+import pickle
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from utils import stereo_rectify
+from utils.stereo_rectify import StereoRectifier, rectify_pair, shift_bilinear, shift_image
+
+CALIB_INI = """\
+[StereoLeft]
+res_x=640
+res_y=512
+fc_x=800.5
+fc_y=801.2
+cc_x=320.3
+cc_y=250.7
+kc_0=-0.1
+kc_1=0.05
+kc_2=0.001
+kc_3=-0.002
+kc_4=0.0
+kc_5=0.0
+kc_6=0.0
+kc_7=0.0
+[StereoRight]
+res_x=640
+res_y=512
+fc_x=799.5
+fc_y=800.2
+cc_x=330.3
+cc_y=248.7
+kc_0=-0.12
+kc_1=0.04
+kc_2=0.0011
+kc_3=-0.0021
+kc_4=0.0
+kc_5=0.0
+kc_6=0.0
+kc_7=0.0
+T_0=-5.0
+T_1=0.1
+T_2=0.2
+R_0=0.9999
+R_1=0.01
+R_2=0.0
+R_3=-0.01
+R_4=0.9999
+R_5=0.0
+R_6=0.0
+R_7=0.0
+R_8=1.0
+"""
+
+
+@pytest.fixture
+def calib_file(tmp_path):
+    path = tmp_path / 'calib.ini'
+    path.write_text(CALIB_INI)
+    return str(path)
+
+
+def _stereo_pair(dtype=torch.float32, n=None, size=(512, 640)):
+    gen = torch.Generator().manual_seed(0)
+    shape = (3,) + size if n is None else (n, 3) + size
+    return tuple((torch.rand(shape, generator=gen) * 255).to(dtype) for _ in range(2))
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.uint8])
+@pytest.mark.parametrize('size', [(512, 640), (540, 700)])
+def test_torch_path_matches_opencv(calib_file, dtype, size):
+    img_left, img_right = _stereo_pair(dtype, size=size)
+    ref = StereoRectifier(calib_file, use_cache=False)(img_left, img_right)
+    rect = StereoRectifier(calib_file, use_cache=False, device='cpu')(img_left, img_right)
+    for a, b in zip(ref, rect):
+        assert torch.equal(a, b)
+
+
+def test_torch_bicubic_saturates(calib_file):
+    # isolated bright dots make bicubic undershoot below 0, which must not wrap around in uint8
+    img = torch.zeros(3, 512, 640, dtype=torch.uint8)
+    img[:, ::4, ::4] = 255
+    rect = StereoRectifier(calib_file, use_cache=False, device='cpu')
+    img_rect = rect._rectify_pair_torch(img, img, method='bicubic')[0]
+    ref = cv2.remap(img.permute(1, 2, 0).numpy().copy(), rect.maps['lmap1'], rect.maps['lmap2'], cv2.INTER_CUBIC)
+    assert (img_rect.permute(1, 2, 0).int() - torch.from_numpy(ref).int()).abs().max() <= 1
+
+
+@pytest.mark.parametrize('device', [None, 'cpu'])
+def test_batch_matches_pairwise(calib_file, device):
+    imgs_left, imgs_right = _stereo_pair(n=3)
+    rect = StereoRectifier(calib_file, use_cache=False, device=device)
+    rect_left, rect_right = rect.rectify_batch(imgs_left, imgs_right)
+    for i in range(3):
+        img_left_rect, img_right_rect = rect(imgs_left[i], imgs_right[i])
+        assert torch.equal(rect_left[i], img_left_rect)
+        assert torch.equal(rect_right[i], img_right_rect)
+
+
+@pytest.mark.parametrize('mode', ['conventional', 'pseudo'])
+def test_empty_batch(calib_file, mode):
+    imgs_left, imgs_right = _stereo_pair(n=0)
+    rect_left, rect_right = StereoRectifier(calib_file, mode=mode, use_cache=False).rectify_batch(imgs_left, imgs_right)
+    assert rect_left.shape == rect_right.shape == (0, 3, 512, 640)
+
+
+@pytest.mark.parametrize('device', ['cpu', pytest.param('cuda', marks=pytest.mark.skipif(
+    not torch.cuda.is_available(), reason='CUDA not available'))])
+def test_enqueue_fetch_matches_call(calib_file, device):
+    img_left, img_right = (img.to(device) for img in _stereo_pair())
+    rect = StereoRectifier(calib_file, use_cache=False, device=device)
+    ref = rect(img_left, img_right)
+    # the enqueued inputs are dropped at once and their memory is refilled before the rectification is fetched
+    rect.enqueue(img_left.clone(), img_right.clone())
+    for _ in range(2):
+        torch.full_like(img_left, -1.)
+    for a, b in zip(ref, rect.fetch()):
+        assert torch.equal(a, b)
+
+
+@pytest.mark.parametrize('device', ['cpu', pytest.param('cuda', marks=pytest.mark.skipif(
+    not torch.cuda.is_available(), reason='CUDA not available'))])
+def test_enqueue_survives_batch_size_change(calib_file, device):
+    imgs_left, imgs_right = (img.to(device) for img in _stereo_pair(n=3))
+    rect = StereoRectifier(calib_file, use_cache=False, device=device)
+    ref = rect.rectify_batch(imgs_left[:2], imgs_right[:2])
+    # the batch of two is sampled on the side stream while another batch size replaces its cached grid
+    rect.enqueue(imgs_left[:2], imgs_right[:2])
+    rect.rectify_batch(imgs_left, imgs_right)
+    for _ in range(2):
+        torch.full_like(imgs_left, -1.)
+    for a, b in zip(ref, rect.fetch()):
+        assert torch.equal(a, b)
+
+
+@pytest.mark.parametrize('device', [None, 'cpu'])
+def test_pickle_roundtrip(calib_file, device):
+    img_left, img_right = _stereo_pair()
+    rect = StereoRectifier(calib_file, use_cache=False, device=device)
+    rect(img_left, img_right)
+    for a, b in zip(rect(img_left, img_right), pickle.loads(pickle.dumps(rect))(img_left, img_right)):
+        assert torch.equal(a, b)
+
+
+def _rectify_in_child(rect, img_left, img_right, queue):
+    queue.put([img.sum().item() for img in rect(img_left, img_right)])
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='fork not available')
+def test_single_threaded_opencv_after_fork(calib_file):
+    img_left, img_right = _stereo_pair()
+    num_threads = cv2.getNumThreads()
+    cv2.setNumThreads(1)
+    try:
+        # the parent starts the remap threads before forking, the child must not wait on them
+        rect = StereoRectifier(calib_file, use_cache=False)
+        ref = [img.sum().item() for img in rect(img_left, img_right)]
+        ctx = multiprocessing.get_context('fork')
+        queue = ctx.Queue()
+        child = ctx.Process(target=_rectify_in_child, args=(rect, img_left, img_right, queue))
+        child.start()
+        child.join(30)
+        hung = child.is_alive()
+        if hung:
+            child.kill()
+        assert not hung
+        assert queue.get(timeout=1) == ref
+    finally:
+        cv2.setNumThreads(num_threads)
+
+
+@pytest.mark.parametrize('mode', ['conventional', 'pseudo'])
+def test_threads_share_rectifier(calib_file, mode):
+    rect = StereoRectifier(calib_file, mode=mode, use_cache=False)
+    pairs = [_stereo_pair(torch.uint8) for _ in range(4)]
+    pairs = [(img_left + i, img_right + i) for i, (img_left, img_right) in enumerate(pairs)]
+    refs = [rect(*pair) for pair in pairs]
+
+    def run(i):
+        return all(all(torch.equal(a, b) for a, b in zip(rect(*pairs[i]), refs[i])) for _ in range(20))
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert all(pool.map(run, range(4)))
+
+
+@pytest.mark.parametrize('size', [(540, 700), (480, 600)])
+def test_frames_of_other_size(calib_file, size):
+    # like cv2.remap, any source size is accepted and the output has the size of the maps
+    gen = torch.Generator().manual_seed(0)
+    imgs_left, imgs_right = (torch.rand((2, 3) + size, generator=gen) * 255 for _ in range(2))
+    rect = StereoRectifier(calib_file, use_cache=False)
+    ref_left, ref_right = rectify_pair(imgs_left[0].permute(1, 2, 0).numpy().copy(),
+                                       imgs_right[0].permute(1, 2, 0).numpy().copy(), rect.maps)
+    img_left_rect, img_right_rect = rect(imgs_left[0], imgs_right[0])
+    assert torch.equal(img_left_rect, torch.from_numpy(ref_left).permute(2, 0, 1))
+    assert torch.equal(img_right_rect, torch.from_numpy(ref_right).permute(2, 0, 1))
+    rect_left, rect_right = rect.rectify_batch(imgs_left, imgs_right)
+    assert torch.equal(rect_left[0], img_left_rect)
+    assert torch.equal(rect_right[0], img_right_rect)
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='POSIX permissions')
+def test_cache_files_use_umask_permissions(calib_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(stereo_rectify, 'MAPS_CACHE_DIR', str(tmp_path / 'maps'))
+    monkeypatch.setattr(stereo_rectify, '_rect_maps_cache', {})
+    StereoRectifier(calib_file)
+    mode = 0o666 & ~stereo_rectify._UMASK
+    for path in [calib_file + '.npz'] + [str(p) for p in (tmp_path / 'maps').iterdir()]:
+        assert stat.S_IMODE(os.stat(path).st_mode) == mode
+
+
+def test_maps_cache_roundtrip(calib_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(stereo_rectify, 'MAPS_CACHE_DIR', str(tmp_path / 'maps'))
+    monkeypatch.setattr(stereo_rectify, '_rect_maps_cache', {})
+    rect = StereoRectifier(calib_file)
+    assert len(list((tmp_path / 'maps').iterdir())) == 1
+    # a new process only has the disk cache, the maps must come from there
+    monkeypatch.setattr(stereo_rectify, '_rect_maps_cache', {})
+    monkeypatch.setattr(stereo_rectify, '_compute_rect_maps', lambda *args, **kwargs: pytest.fail('maps recomputed'))
+    cached = StereoRectifier(calib_file)
+    assert cached.maps.keys() == rect.maps.keys()
+    for name, m in rect.maps.items():
+        assert np.array_equal(cached.maps[name], m)
+        assert not cached.maps[name].flags.writeable
+    assert np.array_equal(cached.l_intr, rect.l_intr)
+    assert np.array_equal(cached.r_intr, rect.r_intr)
+
+
+def test_calib_cache_roundtrip(calib_file):
+    parse = StereoRectifier._load_calib_ini.__wrapped__
+    cal = StereoRectifier._load_calib_ini(calib_file)
+    assert os.path.isfile(calib_file + '.npz')
+    cached = StereoRectifier._load_calib_ini(calib_file)
+    assert cached.keys() == cal.keys() == parse(calib_file).keys()
+    assert cached['img_size'] == cal['img_size']
+    for name in ('lkmat', 'rkmat', 'ld', 'rd', 'T', 'R'):
+        assert np.array_equal(cached[name], cal[name])
+
+    # a modified calibration is parsed again
+    with open(calib_file, 'w') as f:
+        f.write(CALIB_INI.replace('fc_x=800.5', 'fc_x=900.5'))
+    os.utime(calib_file, (os.path.getmtime(calib_file) + 10,) * 2)
+    assert StereoRectifier._load_calib_ini(calib_file)['lkmat'][0, 0] == 900.5
+
+
+@pytest.mark.parametrize('dx, dy', [(0, 0), (-10, 2), (7, -3), (-700, 0), (0, 600)])
+def test_shift_image_matches_warp_affine(dx, dy):
+    img = np.random.default_rng(0).integers(0, 256, (512, 640, 3), dtype=np.uint8)
+    ref = cv2.warpAffine(img, np.float32([[1, 0, dx], [0, 1, dy]]), (640, 512), flags=cv2.INTER_NEAREST)
+    # whatever the destination held before must not survive in the uncovered border
+    assert np.array_equal(shift_image(img, dx, dy, np.full_like(img, 77)), ref)
+
+
+@pytest.mark.parametrize('dx, dy', [(-10.25, 2.0), (3.5, -1.75), (-0.4, 0.6), (-650.5, 0.0)])
+def test_shift_bilinear_matches_warp_affine(dx, dy):
+    img = np.random.default_rng(0).integers(0, 256, (512, 640, 3), dtype=np.uint8)
+    ref = cv2.warpAffine(img, np.float32([[1, 0, dx], [0, 1, dy]]), (640, 512), flags=cv2.INTER_LINEAR)
+    rect = shift_bilinear(img, dx, dy, np.full_like(img, 77))
+    assert np.abs(rect.astype(int) - ref.astype(int)).max() <= 1
+
+
+@pytest.mark.parametrize('cc_x', ['330.3', '330.55'])
+def test_pseudo_rectification(tmp_path, cc_x):
+    # whole-pixel and sub-pixel principal point offsets take the slice copy and the filter2D path
+    calib_file = tmp_path / 'calib.ini'
+    calib_file.write_text(CALIB_INI.replace('cc_x=330.3', 'cc_x=' + cc_x))
+    img_left, img_right = _stereo_pair(torch.uint8)
+    img_left_rect, img_right_rect = StereoRectifier(str(calib_file), mode='pseudo', use_cache=False)(img_left, img_right)
+    assert torch.equal(img_left_rect, img_left)
+    shift = np.float32([[1, 0, 320.3 - float(cc_x)], [0, 1, 250.7 - 248.7]])
+    ref = cv2.warpAffine(img_right.permute(1, 2, 0).numpy().copy(), shift, (640, 512), flags=cv2.INTER_LINEAR)
+    assert (img_right_rect.permute(1, 2, 0).int() - torch.from_numpy(ref).int()).abs().max() <= 1
@@ -7,9 +7,62 @@ from typing import Tuple
 import os
 import configparser
 import json
+import hashlib
+import tempfile
+import functools
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import torch
+import torch.nn.functional as F
 import warnings
 
+MAPS_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'surgpose')
+_MAPS_CACHE_VERSION = 3
+_MAPS_CACHE_KEYS = ('lmap1', 'lmap2', 'rmap1', 'rmap2', 'lmap1_nn', 'rmap1_nn')
+_STACK_PAD = 8
+# bytes of source buffer and tiled maps that rectify_batch keeps around for one chunk of stacked pairs
+_BATCH_CHUNK_BYTES = 64 << 20
+# frame dtypes whose values half precision holds exactly, only these are sampled with fp16 grids
+_FP16_EXACT_DTYPES = (torch.uint8, torch.int8, torch.float16)
+
+# cache files get the permissions of a plain open() rather than the owner-only ones of a temporary file, so a
+# calibration cache next to a shared dataset stays readable for other users. os.umask can only be read by
+# setting it, so it is read once at import.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# rectification maps computed in this process, shared by all StereoRectifier instances of the same calibration
+_rect_maps_cache = {}
+
+# worker threads for remapping both eyes concurrently when OpenCV itself runs single-threaded, started on first use
+_remap_pool = None
+_remap_pool_lock = threading.Lock()
+
+
+def _get_remap_pool():
+    global _remap_pool
+    with _remap_pool_lock:
+        if _remap_pool is None:
+            _remap_pool = ThreadPoolExecutor(max_workers=2)
+        return _remap_pool
+
+
+def _reset_remap_pool():
+    # a forked child inherits the pool object but none of its threads, so it has to start its own
+    global _remap_pool, _remap_pool_lock
+    _remap_pool, _remap_pool_lock = None, threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_remap_pool)
+
+
+def _array_key(a):
+    a = np.asarray(a)
+    return a.dtype.str, a.shape, a.tobytes()
+
+
 def get_rect_maps(
     lcam_mat = None, 
     rcam_mat = None, 
@@ -21,58 +74,234 @@ def get_rect_maps(
     triangular_intrinsics: bool = False,
     mode: str = 'conventional'
     ) -> dict:
+    key = _rect_maps_key(lcam_mat, rcam_mat, rmat, tvec, ldist_coeffs, rdist_coeffs, img_size, triangular_intrinsics, mode)
+    if key not in _rect_maps_cache:
+        _memoize_rect_maps(key, *_compute_rect_maps(lcam_mat, rcam_mat, rmat, tvec, ldist_coeffs, rdist_coeffs,
+                                                    img_size, triangular_intrinsics, mode))
+    maps, p1, p2 = _rect_maps_cache[key]
+    return dict(maps), p1.copy(), p2.copy()
+
+
+def _rect_maps_key(lcam_mat, rcam_mat, rmat, tvec, ldist_coeffs, rdist_coeffs, img_size, triangular_intrinsics, mode):
+    return tuple(_array_key(a) for a in (lcam_mat, rcam_mat, rmat, tvec, ldist_coeffs, rdist_coeffs)) + \
+        (tuple(img_size), triangular_intrinsics, mode)
+
+
+def _memoize_rect_maps(key, maps, p1, p2):
+    # the cached maps are shared between callers, so they must never be modified in place
+    for m in maps.values():
+        m.flags.writeable = False
+    _rect_maps_cache[key] = maps, p1, p2
+
+
+def _compute_rect_maps(lcam_mat, rcam_mat, rmat, tvec, ldist_coeffs, rdist_coeffs, img_size, triangular_intrinsics, mode):
     if mode == 'conventional':
         if triangular_intrinsics:
             lcam_mat = np.array([[lcam_mat[0, 0], 0, lcam_mat[0, 2]], [0, lcam_mat[1, 1], lcam_mat[1, 2]], [0, 0, 1]], dtype=np.float64)
             rcam_mat = np.array([[rcam_mat[0, 0], 0, rcam_mat[0, 2]], [0, rcam_mat[1, 1], rcam_mat[1, 2]], [0, 0, 1]], dtype=np.float64)
+        # calibrations are parsed as float64 already, only cast what is not
+        lcam_mat, rcam_mat = lcam_mat.astype(np.float64, copy=False), rcam_mat.astype(np.float64, copy=False)
+        ldist_coeffs, rdist_coeffs = ldist_coeffs.astype(np.float64, copy=False), rdist_coeffs.astype(np.float64, copy=False)
 
         # compute pixel mappings
-        r1, r2, p1, p2, q, valid_pix_roi1, valid_pix_roi2 = cv2.stereoRectify(cameraMatrix1=lcam_mat.astype('float64'), distCoeffs1=ldist_coeffs.astype('float64'),
-                                                                            cameraMatrix2=rcam_mat.astype('float64'), distCoeffs2=rdist_coeffs.astype('float64'),
-                                                                            imageSize=tuple(img_size), R=rmat.astype('float64'), T=tvec.T.astype('float64'),
+        r1, r2, p1, p2, q, valid_pix_roi1, valid_pix_roi2 = cv2.stereoRectify(cameraMatrix1=lcam_mat, distCoeffs1=ldist_coeffs,
+                                                                            cameraMatrix2=rcam_mat, distCoeffs2=rdist_coeffs,
+                                                                            imageSize=tuple(img_size), R=rmat.astype(np.float64, copy=False), T=tvec.T.astype(np.float64, copy=False),
                                                                             alpha=0)
 
-        lmap1, lmap2 = cv2.initUndistortRectifyMap(cameraMatrix=lcam_mat, distCoeffs=ldist_coeffs, R=r1, newCameraMatrix=p1, size=tuple(img_size), m1type=cv2.CV_32FC1)
-        rmap1, rmap2 = cv2.initUndistortRectifyMap(cameraMatrix=rcam_mat, distCoeffs=ldist_coeffs, R=r2, newCameraMatrix=p2, size=tuple(img_size), m1type=cv2.CV_32FC1)
+        # the eyes are independent and OpenCV releases the GIL, so both are computed at the same time
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            lmaps = pool.submit(_eye_rect_maps, lcam_mat, ldist_coeffs, r1, p1, img_size)
+            rmaps = pool.submit(_eye_rect_maps, rcam_mat, rdist_coeffs, r2, p2, img_size)
+            (lmap1, lmap2, lmap1_nn), (rmap1, rmap2, rmap1_nn) = lmaps.result(), rmaps.result()
         maps = {'lmap1': lmap1,
                 'lmap2': lmap2,
                 'rmap1': rmap1,
-                'rmap2': rmap2}
+                'rmap2': rmap2,
+                'lmap1_nn': lmap1_nn,
+                'rmap1_nn': rmap1_nn}
     elif mode == 'pseudo':
         maps = {}
-        p1 = lcam_mat.astype('float64')
-        p2 = rcam_mat.astype('float64')
+        p1 = lcam_mat.astype(np.float64)
+        p2 = rcam_mat.astype(np.float64)
     else:
         raise NotImplementedError
 
     return maps, p1, p2
 
 
-def rectify_pair(limg, rimg, maps, method='nearest'):
+def _eye_rect_maps(cam_mat, dist_coeffs, rmat, pmat, img_size):
+    map_x, map_y = cv2.initUndistortRectifyMap(cameraMatrix=cam_mat, distCoeffs=dist_coeffs, R=rmat, newCameraMatrix=pmat, size=tuple(img_size), m1type=cv2.CV_32FC1)
+    # fixed-point maps: map1 holds the integer (x, y) pairs, map2 the interpolation table indices.
+    # Nearest neighbour remap ignores map2 and would truncate, so it gets its own rounded (x, y) plane.
+    map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    map1_nn = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2, nninterpolation=True)[0]
+    return map1, map2, map1_nn
 
-    cv_interpol = cv2.INTER_NEAREST if method == 'nearest' else cv2.INTER_CUBIC
 
-    limg_rect = cv2.remap(np.copy(limg), maps['lmap1'], maps['lmap2'], interpolation=cv_interpol)
-    rimg_rect = cv2.remap(np.copy(rimg), maps['rmap1'], maps['rmap2'], interpolation=cv_interpol)
+def _maps_cache_path(calib_file, img_size_new, mode):
+    with open(calib_file, 'rb') as f:
+        key = hashlib.md5(f.read() + repr((img_size_new, mode, _MAPS_CACHE_VERSION)).encode()).hexdigest()
+    return os.path.join(MAPS_CACHE_DIR, 'maps_{}.npz'.format(key))
+
+
+def _load_cached_maps(cache_path):
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as f:
+            maps = {k: f[k] for k in _MAPS_CACHE_KEYS if k in f.files}
+            p1, p2 = f['p1'], f['p2']
+    except (OSError, ValueError, KeyError):
+        return None
+    return maps, p1, p2
+
+
+def _atomic_savez(path, **arrays):
+    # write to a temporary file first so concurrent readers never see a partial archive
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), suffix='.npz', delete=False) as f:
+            np.savez(f, **arrays)
+        os.chmod(f.name, 0o666 & ~_UMASK)
+        os.replace(f.name, path)
+    except OSError as e:
+        warnings.warn('could not write cache {}: {}'.format(path, e), UserWarning)
+
+
+def _save_cached_maps(cache_path, maps, p1, p2):
+    _atomic_savez(cache_path, p1=p1, p2=p2, **maps)
+
+
+def _calib_cache_path(fname):
+    return fname + '.npz'
+
+
+def _cached_calib(loader):
+    # parsed calibrations are stored next to the source file and reused while its mtime is unchanged
+    @functools.wraps(loader)
+    def wrapper(fname):
+        cache_path = _calib_cache_path(fname)
+        mtime = os.path.getmtime(fname)
+        if os.path.isfile(cache_path):
+            try:
+                with np.load(cache_path) as f:
+                    if f['_mtime'] == mtime:
+                        cal = {k: f[k] for k in f.files if k != '_mtime'}
+                        cal['img_size'] = tuple(cal['img_size'].tolist())
+                        return cal
+            except (OSError, ValueError, KeyError):
+                pass
+        cal = loader(fname)
+        _atomic_savez(cache_path, _mtime=mtime, **cal)
+        return cal
+    return wrapper
+
+
+def clear_caches(calib_files=(), maps=False):
+    for fname in calib_files:
+        if os.path.isfile(_calib_cache_path(fname)):
+            os.remove(_calib_cache_path(fname))
+    if maps and os.path.isdir(MAPS_CACHE_DIR):
+        for name in os.listdir(MAPS_CACHE_DIR):
+            if name.startswith('maps_') and name.endswith('.npz'):
+                os.remove(os.path.join(MAPS_CACHE_DIR, name))
+
+
+def _interpolation_flag(method):
+    return cv2.INTER_NEAREST if method == 'nearest' else cv2.INTER_CUBIC
+
+
+def _remap_args(maps, method, side):
+    if method == 'nearest' and side + 'map1_nn' in maps:
+        return maps[side + 'map1_nn'], None
+    return maps[side + 'map1'], maps[side + 'map2']
+
+
+def _float_maps(maps, method, side):
+    # float (x, y) maps for the remap paths that do not take fixed-point planes
+    map1, map2 = _remap_args(maps, method, side)
+    if map2 is None:
+        # the rounded nearest neighbour coordinates are integers, which float32 holds exactly
+        return map1[..., 0].astype(np.float32), map1[..., 1].astype(np.float32)
+    return cv2.convertMaps(map1, map2, cv2.CV_32FC1)
+
+
+def rectify_pair(limg, rimg, maps, method='nearest', ldst=None, rdst=None):
+
+    cv_interpol = _interpolation_flag(method)
+    lmaps, rmaps = _remap_args(maps, method, 'l'), _remap_args(maps, method, 'r')
+
+    # remap never writes to its source, ldst/rdst optionally receive the result in place
+    limg_rect = cv2.remap(limg, *lmaps, interpolation=cv_interpol, dst=ldst)
+    rimg_rect = cv2.remap(rimg, *rmaps, interpolation=cv_interpol, dst=rdst)
 
     return limg_rect, rimg_rect
 
+def stack_rect_maps(maps, pad=_STACK_PAD, method='nearest', src_h=None):
+    # Stack the left maps over the right ones so both eyes are rectified by a single remap call. The right
+    # source image is expected `pad` zero rows below the left one, whose height src_h defaults to the map height.
+    # Samples that would reach into the other eye are pushed out of the image, so they still see the constant
+    # border of two separate remaps.
+    (lmap1, lmap2), (rmap1, rmap2) = _remap_args(maps, method, 'l'), _remap_args(maps, method, 'r')
+    h = lmap1.shape[0] if src_h is None else src_h
+    lmap1, rmap1 = lmap1.copy(), rmap1.copy()
+    for m in (lmap1, rmap1):
+        outside = (m[..., 1] < -(pad // 2)) | (m[..., 1] >= h + pad // 2)
+        m[outside] = (-pad, 0)
+    rmap1[..., 1] += h + pad
+    return np.vstack([lmap1, rmap1]), None if lmap2 is None else np.vstack([lmap2, rmap2])
+
 def pseudo_rectify(rimg, x0, x1):
 
-    tmat = np.array(((1, 0, x0-x1), (0, 1, 0))).astype(np.float32)
-    rimg_rect = cv2.warpAffine(rimg, tmat, (rimg.shape[1], rimg.shape[0]))
+    rimg_rect = shift_bilinear(rimg, x0-x1, 0.0)
 
     return rimg_rect
 
+def shift_image(img, dx, dy, dst):
+    # integer translation dst[y, x] = img[y - dy, x - dx] as a plain slice copy, only the border strips the shift
+    # uncovers are zeroed, so dst may hold anything beforehand
+    hs, ws = img.shape[:2]
+    hd, wd = dst.shape[:2]
+    y0, y1, x0, x1 = max(dy, 0), min(hs + dy, hd), max(dx, 0), min(ws + dx, wd)
+    if y1 <= y0 or x1 <= x0:
+        dst[:] = 0
+        return dst
+    dst[y0:y1, x0:x1] = img[y0 - dy:y1 - dy, x0 - dx:x1 - dx]
+    dst[:y0] = 0
+    dst[y1:] = 0
+    dst[y0:y1, :x0] = 0
+    dst[y0:y1, x1:] = 0
+    return dst
+
+def shift_bilinear(img, dx, dy, dst=None):
+    # Sub-pixel translation with the same result as warpAffine(img, [[1, 0, dx], [0, 1, dy]]) using bilinear
+    # interpolation and a zero border. With constant weights the interpolation is a 2x2 correlation, which
+    # filter2D runs faster than the per-pixel coordinate path of warpAffine, followed by an integer shift.
+    if dst is None:
+        dst = np.empty_like(img)
+    # sample at x - dx, split into integer and fractional part, fractions quantised like warpAffine (1/32 px)
+    ix, iy = int(np.floor(-dx)), int(np.floor(-dy))
+    ax, ay = round((-dx - ix) * cv2.INTER_TAB_SIZE) / cv2.INTER_TAB_SIZE, round((-dy - iy) * cv2.INTER_TAB_SIZE) / cv2.INTER_TAB_SIZE
+    kernel = np.array(((1 - ax) * (1 - ay), ax * (1 - ay), (1 - ax) * ay, ax * ay), dtype=np.float32).reshape(2, 2)
+    # anchor the kernel so its zero border lands on the image edge the shift moves into view
+    anchor = (int(ix < 0), int(iy < 0))
+    filtered = cv2.filter2D(img, -1, kernel, anchor=anchor, borderType=cv2.BORDER_CONSTANT)
+    return shift_image(filtered.reshape(img.shape), -ix - anchor[0], -iy - anchor[1], dst)
+
 def pseudo_rectify_2d(rimg, x0, x1, y0, y1):
 
-    tmat = np.array(((1, 0, x0-x1), (0, 1, y0-y1))).astype(np.float32)
-    rimg_rect = cv2.warpAffine(rimg, tmat, (rimg.shape[1], rimg.shape[0]))
+    rimg_rect = shift_bilinear(rimg, x0-x1, y0-y1)
 
     return rimg_rect
 
 class StereoRectifier(object):
-    def __init__(self, calib_file, img_size_new=None, mode='conventional'):
+    def __init__(self, calib_file, img_size_new=None, mode='conventional', use_cache=True, device=None, fp16_grid=False,
+                 reuse_output=False):
+        # device: rectify with torch grid_sample on this device and return the tensors there (conventional mode only)
+        # fp16_grid: sample uint8, int8 and half frames with half precision grids, halves grid bandwidth at up to
+        # 2^-12 * 639.5 ~ 0.16 px rounding error for 1280 px (half the fp16 spacing near +-1, scaled back to pixels).
+        # grid_sample runs in the grid's dtype, so other frames keep float32 grids rather than being quantised.
         if os.path.splitext(calib_file)[1] == '.json':
             cal = self._load_calib_json(calib_file)
         elif os.path.splitext(calib_file)[1] == '.ini':
@@ -83,6 +312,7 @@ class StereoRectifier(object):
             raise NotImplementedError
 
         assert mode in ['conventional', 'pseudo']
+        assert device is None or mode == 'conventional', 'torch rectification requires conventional mode'
         self.mode = mode
         if self.mode =='pseudo':
             warnings.warn('pseudo rectification used', UserWarning)
@@ -102,7 +332,9 @@ class StereoRectifier(object):
         self.img_size = cal['img_size']
         self.cal = cal
 
-        self.maps, self.l_intr, self.r_intr = get_rect_maps(
+        # rectification maps only depend on the calibration file, the target size and the mode. Maps computed or
+        # loaded earlier in this process are reused without hashing the file or reading the disk cache again.
+        map_args = dict(
             lcam_mat=cal['lkmat'],
             rcam_mat=cal['rkmat'],
             rmat=cal['R'],
@@ -110,22 +342,349 @@ class StereoRectifier(object):
             ldist_coeffs=cal['ld'],
             rdist_coeffs=cal['rd'],
             img_size=tuple(map(round, cal['img_size'])), #cal['img_size'],
+            triangular_intrinsics=False,
             mode=self.mode
         )
+        key = _rect_maps_key(**map_args)
+        if use_cache and key not in _rect_maps_cache:
+            cache_path = _maps_cache_path(calib_file, img_size_new, mode)
+            cached = _load_cached_maps(cache_path)
+            if cached is None:
+                cached = _compute_rect_maps(**map_args)
+                _save_cached_maps(cache_path, *cached)
+            _memoize_rect_maps(key, *cached)
+        self.maps, self.l_intr, self.r_intr = get_rect_maps(**map_args)
+
+        # reuse_output: return views of internal buffers that the next call from the same thread overwrites instead
+        # of fresh tensors
+        self.reuse_output = reuse_output
+        self.device = torch.device(device) if device is not None else None
+        # half precision grid_sample is only reliable in the CUDA kernels
+        self.use_fp16_grid = fp16_grid and self.device is not None and self.device.type == 'cuda'
+        use_cv2 = self.mode == 'conventional' and self.device is None
+        self.use_cuda = use_cv2 and hasattr(cv2, 'cuda') and cv2.cuda.getCudaEnabledDeviceCount() > 0
+        # without CUDA, OpenCV's T-API runs remap as an OpenCL kernel when the maps and frames live in UMats
+        self.use_opencl = use_cv2 and not self.use_cuda and cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL()
+        if self.device is not None:
+            self._init_grids()
+        elif self.mode == 'conventional' and not self.use_cuda:
+            # stacked maps per source frame height, frames normally have the calibrated one
+            self._stacked_maps = {self.maps['lmap1'].shape[0]: stack_rect_maps(self.maps)}
+            self._tiled_maps = {}
+        elif self.mode == 'pseudo':
+            # the pseudo rectification is a fixed translation of the right image
+            x0, x1, y0, y1 = cal['lkmat'][0, 2], cal['rkmat'][0, 2], cal['lkmat'][1, 2], cal['rkmat'][1, 2]
+            self._pseudo_shift = (float(x0-x1), float(y0-y1))
+            # whole-pixel shifts need no interpolation at all
+            self._pseudo_fast = None
+            if np.allclose(self._pseudo_shift, np.round(self._pseudo_shift), rtol=0, atol=1e-4):
+                self._pseudo_fast = tuple(int(v) for v in np.round(self._pseudo_shift))
+        self._init_runtime()
+
+    # device handles and per-thread state that cannot be pickled, they are dropped with the state and rebuilt by
+    # _init_runtime
+    _RUNTIME_ATTRS = ('_local', '_u_stacked_maps', '_gpu_maps', '_stream')
+
+    def _init_runtime(self):
+        # scratch buffers and pending enqueue results are kept per thread, so threads can share one rectifier
+        self._local = threading.local()
+        if self.device is not None:
+            self._stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        elif self.use_cuda:
+            self._init_cuda()
+        elif self.use_opencl:
+            self._u_stacked_maps = {}
+
+    def __getstate__(self):
+        # rectifiers are handed to spawned dataloader workers by pickling
+        state = self.__dict__.copy()
+        for name in self._RUNTIME_ATTRS:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime()
+
+    def _buffer(self, name, shape, dtype, zero=False):
+        # scratch arrays are reused across frames and only reallocated when the frame layout changes
+        buffers = self._local.__dict__.setdefault('buffers', {})
+        buf = buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = buffers[name] = np.zeros(shape, dtype=dtype) if zero else np.empty(shape, dtype=dtype)
+        return buf
+
+    def _output_buffer(self, name, shape, dtype, zero=False):
+        # results are only written into the persistent buffers when the caller opted into aliasing them
+        if self.reuse_output:
+            return self._buffer(name, shape, dtype, zero)
+        return np.zeros(shape, dtype=dtype) if zero else np.empty(shape, dtype=dtype)
+
+    def _init_grids(self):
+        # pixel sampling maps on the device, left and right stacked so both eyes go through one grid_sample call.
+        # Nearest samples the rounded integer maps so it picks the same pixels as the OpenCV paths, bicubic
+        # the fractional ones.
+        self._pix_maps = {}
+        for method in ('nearest', 'bicubic'):
+            maps = [np.stack(_float_maps(self.maps, method, side), axis=-1) for side in ('l', 'r')]
+            self._pix_maps[method] = torch.from_numpy(np.stack(maps)).to(self.device)
+        self._grid, self._grid_batch = {}, {}
+
+    def _batch_grid(self, n, method, size, dtype):
+        # grid_sample scales normalised coordinates by the size of its input, so the grids are normalised per input
+        # size. It needs one grid per image, the repeated grids are kept for the last batch size seen.
+        key = method, tuple(size), dtype
+        grid = self._grid.get(key)
+        if grid is None:
+            h, w = size
+            scale = torch.tensor([2 / (w - 1), 2 / (h - 1)], device=self.device)
+            grid = self._grid[key] = (self._pix_maps[method] * scale - 1).to(dtype)
+        batch = self._grid_batch.get(key)
+        if batch is None or batch.shape[0] != 2 * n:
+            batch = self._grid_batch[key] = grid if n == 1 else grid.repeat_interleave(n, dim=0)
+        return batch
+
+    def _rectify_pair_torch(self, img_left, img_right, method='nearest', non_blocking=False):
+        batched = img_left.dim() == 4
+        if not batched:
+            img_left, img_right = img_left[None], img_right[None]
+        n = img_left.shape[0]
+        imgs = torch.cat([img_left, img_right])
+        if non_blocking and imgs.device.type == 'cpu' and self.device.type == 'cuda':
+            # only page-locked host memory is uploaded asynchronously
+            imgs = imgs.pin_memory()
+        method = 'nearest' if method == 'nearest' else 'bicubic'
+        half = self.use_fp16_grid and img_left.dtype in _FP16_EXACT_DTYPES
+        grid = self._batch_grid(n, method, imgs.shape[-2:], torch.float16 if half else torch.float32)
+        if grid.is_cuda:
+            # the cached grid is shared by __call__ and the enqueue side stream and freed when the batch size
+            # changes, its memory must not be reused while the stream sampling it now has not finished
+            grid.record_stream(torch.cuda.current_stream(self.device))
+        imgs = imgs.to(self.device, grid.dtype, non_blocking=non_blocking)
+        rect = F.grid_sample(imgs, grid, mode=method, padding_mode='zeros', align_corners=True)
+        if not img_left.is_floating_point():
+            # bicubic overshoots the input range, saturate like OpenCV instead of wrapping around
+            info = torch.iinfo(img_left.dtype)
+            rect = rect.round().clamp_(info.min, info.max)
+        rect = rect.to(img_left.dtype)
+        if not batched:
+            return rect[0], rect[1]
+        return rect[:n], rect[n:]
+
+    def _init_cuda(self):
+        # cv2.cuda.remap only accepts float maps, convert and upload them once. Its nearest filter truncates,
+        # so nearest gets the rounded integer maps and the interpolating methods the fractional ones.
+        self._gpu_maps = {}
+        for method in ('nearest', 'cubic'):
+            for side in ('l', 'r'):
+                self._gpu_maps[method, side] = (cv2.cuda_GpuMat(), cv2.cuda_GpuMat())
+                for gpu_map, m in zip(self._gpu_maps[method, side], _float_maps(self.maps, method, side)):
+                    gpu_map.upload(m)
+
+    def _gpu_scratch(self):
+        # upload/download frames and streams of the calling thread, the maps are shared
+        if not hasattr(self._local, 'gpu_src'):
+            self._local.gpu_src = {side: cv2.cuda_GpuMat() for side in ('l', 'r')}
+            self._local.gpu_dst = {side: cv2.cuda_GpuMat() for side in ('l', 'r')}
+            self._local.gpu_streams = {side: cv2.cuda_Stream() for side in ('l', 'r')}
+        return self._local.gpu_src, self._local.gpu_dst, self._local.gpu_streams
+
+    def _rectify_pair_cuda(self, limg, rimg, method='nearest'):
+        cv_interpol = _interpolation_flag(method)
+        gpu_src, gpu_dst, gpu_streams = self._gpu_scratch()
+        # enqueue both eyes on separate streams before downloading so left and right overlap
+        for side, img in (('l', limg), ('r', rimg)):
+            stream = gpu_streams[side]
+            gpu_src[side].upload(np.ascontiguousarray(img), stream)
+            cv2.cuda.remap(gpu_src[side], *self._gpu_maps['nearest' if method == 'nearest' else 'cubic', side],
+                           cv_interpol, dst=gpu_dst[side], stream=stream)
+        limg_rect = gpu_dst['l'].download(gpu_streams['l'])
+        rimg_rect = gpu_dst['r'].download(gpu_streams['r'])
+        gpu_streams['l'].waitForCompletion()
+        gpu_streams['r'].waitForCompletion()
+        return limg_rect, rimg_rect
+
+    def _to_hwc(self, name, img, output=False):
+        # a single transposing copy into a persistent HWC buffer that OpenCV can read contiguously
+        img = img.numpy()
+        buffer = self._output_buffer if output else self._buffer
+        buf = buffer(name, img.shape[1:] + img.shape[:1], img.dtype)
+        np.copyto(buf, img.transpose(1, 2, 0))
+        return buf
+
+    def _stacked_maps_for(self, h):
+        # the right eye sits below a left eye of the frame's own height, which may differ from the calibration
+        maps = self._stacked_maps.get(h)
+        if maps is None:
+            maps = self._stacked_maps[h] = stack_rect_maps(self.maps, src_h=h)
+        return maps
+
+    def _u_stacked_maps_for(self, h):
+        maps = self._u_stacked_maps.get(h)
+        if maps is None:
+            maps = self._u_stacked_maps[h] = tuple(None if m is None else cv2.UMat(m) for m in self._stacked_maps_for(h))
+        return maps
+
+    def _remap_stacked(self, src, dst, cv_interpol, maps):
+        map1, map2 = maps
+        if cv2.getNumThreads() > 1:
+            return cv2.remap(src, map1, map2, interpolation=cv_interpol, dst=dst)
+        # OpenCV runs single-threaded (e.g. cv2.setNumThreads(0) in dataloader workers), remap releases
+        # the GIL so the two halves (the two eyes of a single pair) can still be rectified concurrently
+        h = dst.shape[0] // 2
+        pool = _get_remap_pool()
+        futures = [pool.submit(cv2.remap, src, map1[rows], None if map2 is None else map2[rows],
+                                     interpolation=cv_interpol, dst=dst[rows])
+                   for rows in (slice(None, h), slice(h, None))]
+        for f in futures:
+            f.result()
+        return dst
+
+    def _to_hwc_stacked(self, img_left, img_right):
+        # both eyes are transposed straight into one tall buffer, separated by the zero rows of stack_rect_maps
+        img_left, img_right = img_left.numpy(), img_right.numpy()
+        h = img_left.shape[1]
+        shape = (2 * h + _STACK_PAD,) + img_left.shape[2:] + img_left.shape[:1]
+        src = self._buffer('stacked_src', shape, img_left.dtype, zero=True)
+        np.copyto(src[:h], img_left.transpose(1, 2, 0))
+        np.copyto(src[h + _STACK_PAD:], img_right.transpose(1, 2, 0))
+        return src
+
+    def _batch_chunk(self, h, src_pair_bytes):
+        # the stacked maps hold int16 source rows, which bounds how many pairs fit in one remap. The chunk's source
+        # buffer and tiled maps are kept for the next batch, so their size is capped as well.
+        map_pair_bytes = sum(m.nbytes for m in self._stacked_maps_for(h) if m is not None)
+        chunk = min(np.iinfo(np.int16).max // (2 * (h + _STACK_PAD)), _BATCH_CHUNK_BYTES // (src_pair_bytes + map_pair_bytes))
+        return max(chunk, 1)
+
+    def _tiled_stacked_maps(self, n, h):
+        # The stacked maps repeated for n pairs of height h. Pair i reads the source block starting at row
+        # i * 2 * (h + pad): the left eye, the pad, the right eye and another pad that keeps the next pair's left
+        # eye out of reach.
+        stacked = self._stacked_maps_for(h)
+        if n == 1:
+            return stacked
+        rows = n * stacked[0].shape[0]
+        tiled = self._tiled_maps.get(h)
+        if tiled is None or tiled[0].shape[0] < rows:
+            map1, map2 = stacked
+            map1 = np.tile(map1, (n, 1, 1))
+            offsets = np.arange(n, dtype=np.int16) * np.int16(2 * (h + _STACK_PAD))
+            map1.reshape((n, -1) + map1.shape[1:])[..., 1] += offsets[:, None, None]
+            tiled = self._tiled_maps[h] = map1, None if map2 is None else np.tile(map2, (n, 1))
+        map1, map2 = tiled
+        return map1[:rows], None if map2 is None else map2[:rows]
+
+    def _rectify_batch_stacked(self, imgs_left, imgs_right):
+        # chunks of pairs are transposed into one tall source and remapped straight into the batch output
+        n, c, h = imgs_left.shape[:3]
+        h_rect = self.maps['lmap1'].shape[0]
+        imgs_left, imgs_right = imgs_left.numpy(), imgs_right.numpy()
+        block = (2 * (h + _STACK_PAD),) + imgs_left.shape[3:] + (c,)
+        chunk = min(self._batch_chunk(h, int(np.prod(block)) * imgs_left.itemsize), n)
+        src = self._buffer('batch_src', (chunk,) + block, imgs_left.dtype, zero=True)
+        out = self._output_buffer('batch_dst', (n, 2 * h_rect) + self.maps['lmap1'].shape[1:2] + (c,), imgs_left.dtype)
+        for i in range(0, n, chunk):
+            m = min(chunk, n - i)
+            np.copyto(src[:m, :h], imgs_left[i:i + m].transpose(0, 2, 3, 1))
+            np.copyto(src[:m, h + _STACK_PAD:2 * h + _STACK_PAD], imgs_right[i:i + m].transpose(0, 2, 3, 1))
+            self._remap_stacked(src[:m].reshape((-1,) + src.shape[2:]), out[i:i + m].reshape((-1,) + out.shape[2:]),
+                                _interpolation_flag('nearest'), self._tiled_stacked_maps(m, h))
+        return out[:, :h_rect], out[:, h_rect:]
 
     def __call__(self, img_left, img_right):
-        img_left = img_left.permute(1,2,0).numpy()
-        img_right = img_right.permute(1, 2, 0).numpy()
+        # with reuse_output the returned tensors share memory with internal buffers that the next call overwrites
+        if self.device is not None:
+            return self._rectify_pair_torch(img_left, img_right)
         if self.mode == 'pseudo':
-            x0, x1, y0, y1 = self.cal['lkmat'][0][-1], self.cal['rkmat'][0][-1], self.cal['lkmat'][1][-1], self.cal['rkmat'][1][-1]
-            img_right_rect = pseudo_rectify_2d(img_right, x0, x1, y0, y1)
+            # the left image is returned as is, so it is transposed straight into its output
+            img_left = self._to_hwc('lsrc', img_left, output=True)
+            img_right = self._to_hwc('rsrc', img_right)
+            rdst = self._output_buffer('pseudo_dst', img_right.shape, img_right.dtype)
+            if self._pseudo_fast is not None:
+                img_right_rect = shift_image(img_right, *self._pseudo_fast, rdst)
+            else:
+                img_right_rect = shift_bilinear(img_right, *self._pseudo_shift, rdst)
             img_left_rect = img_left
+        elif self.use_cuda:
+            img_left = self._to_hwc('lsrc', img_left)
+            img_right = self._to_hwc('rsrc', img_right)
+            img_left_rect, img_right_rect = self._rectify_pair_cuda(img_left, img_right)
+        elif img_left.shape != img_right.shape:
+            # the stacked layout needs both eyes in the same shape
+            img_left_rect, img_right_rect = rectify_pair(self._to_hwc('lsrc', img_left), self._to_hwc('rsrc', img_right), self.maps)
         else:
-            img_left_rect, img_right_rect = rectify_pair(img_left, img_right, self.maps)
-        img_left_rect = torch.tensor(img_left_rect).permute(2,0,1)
-        img_right_rect = torch.tensor(img_right_rect).permute(2,0,1)
+            src = self._to_hwc_stacked(img_left, img_right)
+            h_src = img_left.shape[1]
+            if self.use_opencl:
+                dst = cv2.remap(cv2.UMat(src), *self._u_stacked_maps_for(h_src), interpolation=_interpolation_flag('nearest')).get()
+            else:
+                maps = self._stacked_maps_for(h_src)
+                dst = self._output_buffer('stacked_dst', maps[0].shape[:2] + src.shape[2:], src.dtype)
+                dst = self._remap_stacked(src, dst, _interpolation_flag('nearest'), maps)
+            h = self.maps['lmap1'].shape[0]
+            img_left_rect, img_right_rect = dst[:h], dst[h:]
+        img_left_rect = torch.from_numpy(img_left_rect).permute(2,0,1)
+        img_right_rect = torch.from_numpy(img_right_rect).permute(2,0,1)
+        return img_left_rect, img_right_rect
+
+    def enqueue(self, img_left, img_right):
+        # Start rectifying a pair on a side CUDA stream and return immediately. A video loop calls
+        # enqueue(next pair) before running its model on the current pair, then fetch() for the next result.
+        # Every thread has its own pending pair.
+        assert self.device is not None, 'enqueue requires the torch rectification path (device=...)'
+        assert getattr(self._local, 'pending', None) is None, 'fetch the previous pair before enqueueing a new one'
+        if self._stream is None:
+            self._local.pending = self._rectify_pair_torch(img_left, img_right), None
+            return
+        # inputs already on the GPU may still be written by work queued on the caller's stream
+        self._stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self._stream):
+            rect = self._rectify_pair_torch(img_left, img_right, non_blocking=True)
+            done = torch.cuda.Event()
+            done.record(self._stream)
+        # the caller may free the inputs right away, keep their memory from being reused before the side stream read it
+        for img in (img_left, img_right):
+            if img.is_cuda:
+                img.record_stream(self._stream)
+        self._local.pending = rect, done
+
+    def fetch(self):
+        assert getattr(self._local, 'pending', None) is not None, 'fetch called without a matching enqueue'
+        (img_left_rect, img_right_rect), done = self._local.pending
+        self._local.pending = None
+        if done is not None:
+            # order the caller's stream after the rectification without blocking the host
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(done)
+            # rect tensors came from the side stream's allocator pool, keep them alive for the caller's stream
+            img_left_rect.record_stream(current)
+            img_right_rect.record_stream(current)
         return img_left_rect, img_right_rect
 
+    def rectify_batch(self, imgs_left, imgs_right):
+        # imgs_left, imgs_right: (N, C, H, W) tensors, returned rectified in the same layout
+        if len(imgs_left) == 0:
+            size = self.maps['lmap1'].shape[:2] if self.mode == 'conventional' else imgs_left.shape[2:]
+            device = imgs_left.device if self.device is None else self.device
+            return (imgs_left.new_empty((0, imgs_left.shape[1]) + tuple(size), device=device),
+                    imgs_right.new_empty((0, imgs_right.shape[1]) + tuple(size), device=device))
+        if self.device is not None:
+            return self._rectify_pair_torch(imgs_left, imgs_right)
+        if self.mode == 'conventional' and not self.use_cuda and not self.use_opencl and imgs_left.shape == imgs_right.shape:
+            rect_left, rect_right = self._rectify_batch_stacked(imgs_left, imgs_right)
+            return torch.from_numpy(rect_left).permute(0,3,1,2), torch.from_numpy(rect_right).permute(0,3,1,2)
+        # with reuse_output the per-pair results live in reused buffers, so copy each one out before the next call
+        rect_left = rect_right = None
+        for i, (img_left, img_right) in enumerate(zip(imgs_left, imgs_right)):
+            img_left_rect, img_right_rect = self(img_left, img_right)
+            if rect_left is None:
+                rect_left = img_left_rect.new_empty((len(imgs_left),) + img_left_rect.shape)
+                rect_right = img_right_rect.new_empty((len(imgs_right),) + img_right_rect.shape)
+            rect_left[i].copy_(img_left_rect)
+            rect_right[i].copy_(img_right_rect)
+        return rect_left, rect_right
+
     def get_rectified_calib(self):
         calib_rectifed = {'intrinsics': {}}
         calib_rectifed['intrinsics']['left'] = self.l_intr[:3,:3]
@@ -141,27 +700,24 @@ class StereoRectifier(object):
         return calib_rectifed
 
     @staticmethod
+    @_cached_calib
     def _load_calib_json(fname):
 
-        with open(fname, 'rb') as f: json_dict = json.load(f)
-
-        lkmat = np.eye(3)
-        lkmat[0, 0] = json_dict['data']['intrinsics'][0]['f'][0]
-        lkmat[1, 1] = json_dict['data']['intrinsics'][0]['f'][1]
-        lkmat[:2, -1] = json_dict['data']['intrinsics'][0]['c']
+        with open(fname, 'rb') as f: json_dict = json.loads(f.read())
+        data = json_dict['data']
+        lintr, rintr = data['intrinsics'][0], data['intrinsics'][1]
 
-        rkmat = np.eye(3)
-        rkmat[0, 0] = json_dict['data']['intrinsics'][1]['f'][0]
-        rkmat[1, 1] = json_dict['data']['intrinsics'][1]['f'][1]
-        rkmat[:2, -1] = json_dict['data']['intrinsics'][1]['c']
+        lkmat = np.array([[lintr['f'][0], 0, lintr['c'][0]], [0, lintr['f'][1], lintr['c'][1]], [0, 0, 1]], dtype=np.float64)
+        rkmat = np.array([[rintr['f'][0], 0, rintr['c'][0]], [0, rintr['f'][1], rintr['c'][1]], [0, 0, 1]], dtype=np.float64)
 
-        ld = np.array(json_dict['data']['intrinsics'][0]['k'])
-        rd = np.array(json_dict['data']['intrinsics'][1]['k'])
+        ld = np.array(lintr['k'])
+        rd = np.array(rintr['k'])
 
-        tvec = np.array(json_dict['data']['extrinsics']['T'])
-        rmat = cv2.Rodrigues(np.array(json_dict['data']['extrinsics']['om']))[0]
+        # the Rodrigues conversion ends up in the parsed calibration cache together with everything else
+        tvec = np.array(data['extrinsics']['T'])
+        rmat = cv2.Rodrigues(np.array(data['extrinsics']['om']))[0]
 
-        img_size = (json_dict['data']['width'], json_dict['data']['height'])
+        img_size = (data['width'], data['height'])
 
         cal = {}
         cal['lkmat'] = lkmat
@@ -175,6 +731,7 @@ class StereoRectifier(object):
         return cal
 
     @staticmethod
+    @_cached_calib
     def _load_calib_ini(fname):
         config = configparser.ConfigParser()
         config.read(fname)
@@ -192,24 +749,11 @@ class StereoRectifier(object):
         rkmat[0, 2] = float(config['StereoRight']['cc_x'])
         rkmat[1, 2] = float(config['StereoRight']['cc_y'])
 
-        ld = np.array([float(config['StereoLeft']['kc_0']),float(config['StereoLeft']['kc_1']),
-                       float(config['StereoLeft']['kc_2']),float(config['StereoLeft']['kc_3']),float(config['StereoLeft']['kc_4']),
-                       float(config['StereoLeft']['kc_5']), float(config['StereoLeft']['kc_6']),float(config['StereoLeft']['kc_7'])])
-        rd = np.array([float(config['StereoRight']['kc_0']),float(config['StereoRight']['kc_1']),
-                       float(config['StereoRight']['kc_2']),float(config['StereoRight']['kc_3']),float(config['StereoRight']['kc_4']),
-                       float(config['StereoRight']['kc_5']), float(config['StereoRight']['kc_6']),float(config['StereoRight']['kc_7'])])
-
-        tvec = np.array([float(config['StereoRight']['T_0']),float(config['StereoRight']['T_1']),float(config['StereoRight']['T_2'])])
-        rmat = np.zeros((3,3))
-        rmat[0, 0] = float(config['StereoRight']['R_0'])
-        rmat[0, 1] = float(config['StereoRight']['R_1'])
-        rmat[0, 2] = float(config['StereoRight']['R_2'])
-        rmat[1, 0] = float(config['StereoRight']['R_3'])
-        rmat[1, 1] = float(config['StereoRight']['R_4'])
-        rmat[1, 2] = float(config['StereoRight']['R_5'])
-        rmat[2, 0] = float(config['StereoRight']['R_6'])
-        rmat[2, 1] = float(config['StereoRight']['R_7'])
-        rmat[2, 2] = float(config['StereoRight']['R_8'])
+        ld = np.fromiter((config['StereoLeft'].getfloat(f'kc_{i}') for i in range(8)), dtype=np.float64, count=8)
+        rd = np.fromiter((config['StereoRight'].getfloat(f'kc_{i}') for i in range(8)), dtype=np.float64, count=8)
+
+        tvec = np.fromiter((config['StereoRight'].getfloat(f'T_{i}') for i in range(3)), dtype=np.float64, count=3)
+        rmat = np.fromiter((config['StereoRight'].getfloat(f'R_{i}') for i in range(9)), dtype=np.float64, count=9).reshape(3, 3)
 
         cal = {}
         cal['lkmat'] = lkmat
@@ -223,6 +767,7 @@ class StereoRectifier(object):
         return cal
 
     @staticmethod
+    @_cached_calib
     def _load_calib_yaml(fname):
         fs = cv2.FileStorage(fname, cv2.FILE_STORAGE_READ)
         img_size = (int(fs.getNode('Camera.width').real()), int(fs.getNode('Camera.height').real()))
@@ -246,3 +791,12 @@ class StereoRectifier(object):
         cal['img_size'] = img_size
 
         return cal
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the cached stereo calibrations and rectification maps')
+    parser.add_argument('--clear-calib-cache', type=str, nargs='+', default=[], metavar='CALIB_FILE', help='remove the parsed calibration cache of these files')
+    parser.add_argument('--clear-maps-cache', action='store_true', help='remove all cached rectification maps in {}'.format(MAPS_CACHE_DIR))
+    args = parser.parse_args()
+
+    clear_caches(args.clear_calib_cache, maps=args.clear_maps_cache)